@@ -1,15 +1,105 @@
+import ctypes
+import hashlib
+import marshal
+import os
 import re
+import subprocess
+import tempfile
+from collections.abc import Iterator
+from contextlib import contextmanager
+from dataclasses import dataclass
 from pathlib import Path
-from sys import argv, stderr
+from sys import argv, implementation, stderr
 
+ADDS = re.compile(r"[-+]+")
+MOVES = re.compile(r"[<>]+")
+MOVES_AND_ADDS = re.compile(r"[-+<>]+")
+MULTIPLY = re.compile(r"\[([-+<>]*)\]")
+
+# Every byte other than the 8 instructions, to be deleted as comments
+COMMENTS = bytes(byte for byte in range(256) if byte not in b"+-<>[],.")
+
+# How many bytes of output are collected before they're written
+OUTPUT_BUFFER_SIZE = 4096
+
+CACHE_DIR = Path.home() / ".cache" / "dementia"
+
+# Bump whenever the generated code changes so stale cache entries are ignored
+CACHE_VERSION = 6
+
+
+# Parsed Brainfuck operations, after the patterns below have been recognized.
+# Offsets are relative to the current cell.
+
+
+@dataclass(frozen=True)
+class Add:
+    offset: int
+    amount: int
+
+
+@dataclass(frozen=True)
+class Move:
+    count: int
+
+
+@dataclass(frozen=True)
+class Clear:
+    pass
+
+
+@dataclass(frozen=True)
+class Multiply:
+    # (offset, multiplier) pairs, kept as a tuple so instructions stay hashable
+    multipliers: tuple[tuple[int, int], ...]
+
+
+@dataclass(frozen=True)
+class Scan:
+    step: int
+
+
+@dataclass(frozen=True)
+class Loop:
+    pass
+
+
+@dataclass(frozen=True)
+class EndLoop:
+    pass
+
+
+@dataclass(frozen=True)
+class Input:
+    pass
 
-class Python:
-    def __init__(self):
-        self.lines = [
-            "tape = [0] * 512",
-            "ptr = 0",
-        ]
-        self.indentation = 0
+
+@dataclass(frozen=True)
+class Output:
+    pass
+
+
+@dataclass(frozen=True)
+class Write:
+    data: bytes
+
+
+Instruction = (
+    Add | Move | Clear | Multiply | Scan | Loop | EndLoop | Input | Output | Write
+)
+
+
+class Code:
+    """
+    Generated source code, built up one line at a time.
+
+    Subclasses turn each instruction into lines of their language, so
+    parsing doesn't need to know which language is being generated.
+    """
+
+    def __init__(self, lines: list[str]):
+        self.lines = lines
+        self.indentation = 4
 
     def emit(self, line: str):
         self.lines.append(f"{' ' * self.indentation}{line}")
@@ -20,16 +110,221 @@ class Python:
     def dedent(self):
         self.indentation -= 4
 
-    def exec(self):
-        exec("\n".join(self.lines))
+    def cell(self, offset: int) -> str:
+        if offset > 0:
+            return f"tape[ptr + {offset}]"
+        if offset < 0:
+            return f"tape[ptr - {-offset}]"
+        return "tape[ptr]"
+
+
+class Python(Code):
+    def __init__(self):
+        # The program is wrapped in a function so that `tape` and `ptr` are
+        # fast locals rather than globals looked up by name on every access.
+        # Output is collected in a bytearray and written in bulk, since a
+        # print() per byte costs far more than the byte itself. It's written
+        # out once enough has built up, so long-running programs still show
+        # progress, and whatever is left is written in a `finally`
+        super().__init__(
+            [
+                "from sys import stdin, stdout",
+                "def program():",
+                "    tape = bytearray(30000)",
+                "    ptr = 0",
+                "    output = bytearray()",
+                "    def flush_output():",
+                "        stdout.buffer.write(output)",
+                "        stdout.buffer.flush()",
+                "        output.clear()",
+                "    def put(byte):",
+                "        output.append(byte)",
+                f"        if len(output) >= {OUTPUT_BUFFER_SIZE}:",
+                "            flush_output()",
+                "    def put_bytes(data):",
+                "        output.extend(data)",
+                f"        if len(output) >= {OUTPUT_BUFFER_SIZE}:",
+                "            flush_output()",
+                "    try:",
+            ]
+        )
+        self.indent()
+
+        # Adds, moves and clears between other instructions are collected
+        # here, by offset from where the pointer was when collecting began,
+        # so each cell is updated once and the pointer is moved once
+        self.amounts: dict[int, int] = {}
+        self.cleared: set[int] = set()
+        self.shift = 0
+
+    def emit(self, line: str):
+        self.flush()
+        super().emit(line)
+
+    def flush(self):
+        """
+        Emits the collected adds, moves and clears with one update per cell
+        and a single pointer move at the end. For example, `>+>[-]++>`
+        becomes:
+
+            tape[ptr + 1] = (tape[ptr + 1] + 1) & 0xFF
+            tape[ptr + 2] = 2
+            ptr += 3
+        """
+
+        amounts, cleared, shift = self.amounts, self.cleared, self.shift
+        self.amounts, self.cleared, self.shift = {}, set(), 0
+
+        for offset, amount in amounts.items():
+            cell = self.cell(offset)
+            if offset in cleared:
+                super().emit(f"{cell} = {amount & 0xFF}")
+            elif amount & 0xFF:
+                super().emit(f"{cell} = ({cell} + {amount}) & 0xFF")
+
+        if shift:
+            super().emit(f"ptr += {shift}")
+
+    def dedent(self):
+        self.flush()
+        # A body that produces no code, like [] or [+-] once its adds cancel
+        # out, still needs a statement
+        if self.lines[-1].endswith(":"):
+            self.emit("pass")
+        super().dedent()
+
+    def add(self, offset: int, amount: int):
+        offset += self.shift
+        self.amounts[offset] = self.amounts.get(offset, 0) + amount
+
+    def move(self, count: int):
+        self.shift += count
+
+    def clear(self):
+        self.amounts[self.shift] = 0
+        self.cleared.add(self.shift)
+
+    def multiply(self, multipliers: tuple[tuple[int, int], ...]):
+        # The loop is often skipped entirely, so only pay for the
+        # multiplications when the cell isn't already 0
+        self.emit("if tape[ptr]:")
+        self.indent()
+        for offset, mul in multipliers:
+            cell = self.cell(offset)
+            value = "tape[ptr]" if mul == 1 else f"tape[ptr] * {mul}"
+            self.emit(f"{cell} = ({cell} + {value}) & 0xFF")
+        self.emit("tape[ptr] = 0")
+        self.dedent()
+
+    def scan(self, step: int):
+        # Searching the bytearray runs in C instead of one iteration per cell
+        if step == 1:
+            self.emit("ptr = tape.index(0, ptr)")
+        else:
+            self.emit("ptr = tape.rindex(0, 0, ptr + 1)")
+
+    def loop(self):
+        # Testing the cell directly lets CPython jump on its truthiness
+        # instead of comparing it to 0 first, on both ends of the loop
+        self.emit("while tape[ptr]:")
+        self.indent()
+
+    def end_loop(self):
+        self.dedent()
+
+    def input(self):
+        # Flush pending output first in case it's a prompt
+        self.emit("flush_output()")
+        self.emit("tape[ptr] = (stdin.buffer.read(1) or b'\\0')[0]")
+
+    def output(self):
+        self.emit("put(tape[ptr])")
+
+    def write(self, data: bytes):
+        self.emit(f"put_bytes({data!r})")
+
+    def source(self) -> str:
+        self.dedent()
+        return "\n".join(
+            [*self.lines, "    finally:", "        stdout.buffer.write(output)"]
+        )
+
+
+class C(Code):
+    def __init__(self):
+        super().__init__(
+            [
+                "#include <stdio.h>",
+                "#include <string.h>",
+                "void run(unsigned char *tape) {",
+                "    int ptr = 0;",
+            ]
+        )
+
+    # Cells are unsigned chars, so they wrap around without any masking
+
+    def add(self, offset: int, amount: int):
+        self.emit(f"{self.cell(offset)} += {amount};")
+
+    def move(self, count: int):
+        self.emit(f"ptr += {count};")
+
+    def clear(self):
+        self.emit("tape[ptr] = 0;")
+
+    def multiply(self, multipliers: tuple[tuple[int, int], ...]):
+        self.emit("if (tape[ptr]) {")
+        self.indent()
+        for offset, mul in multipliers:
+            self.emit(f"{self.cell(offset)} += tape[ptr] * {mul};")
+        self.emit("tape[ptr] = 0;")
+        self.dedent()
+        self.emit("}")
+
+    def scan(self, step: int):
+        if step == 1:
+            found = "(unsigned char *)memchr(&tape[ptr], 0, 30000 - ptr)"
+            self.emit(f"ptr = {found} - tape;")
+        else:
+            self.emit("while (tape[ptr]) ptr--;")
+
+    def loop(self):
+        self.emit("while (tape[ptr]) {")
+        self.indent()
+
+    def end_loop(self):
+        self.dedent()
+        self.emit("}")
+
+    def input(self):
+        self.emit("fflush(stdout);")
+        self.emit("{ int c = getchar(); tape[ptr] = c == EOF ? 0 : c; }")
+
+    def output(self):
+        self.emit("putchar(tape[ptr]);")
+
+    def write(self, data: bytes):
+        # Octal escapes are at most 3 digits, so unlike \x they can't run
+        # into a following character
+        literal = "".join(f"\\{byte:03o}" for byte in data)
+        self.emit(f'fwrite("{literal}", 1, {len(data)}, stdout);')
+
+    def source(self) -> str:
+        return "\n".join([*self.lines, "    fflush(stdout);", "}"])
 
 
 class Brainfuck:
     def __init__(self, path: str):
-        self.code = Path(path).read_text()
+        # Everything other than the 8 instructions is a comment, so strip it
+        # upfront to let patterns match across whitespace and save work.
+        # Deleting them from the raw bytes means they're never decoded, so
+        # comments in any encoding are fine
+        self.code = Path(path).read_bytes().translate(None, COMMENTS).decode()
         self.ptr = 0
 
-    def count_delta(self, positive: str, negative: str) -> int:
+    def count_delta(
+        self, pattern: re.Pattern[str], positive: str, negative: str
+    ) -> int:
         """
         Multiple instructions do the same operation but with different counts, e.g.:
 
@@ -42,100 +337,405 @@ class Brainfuck:
             >>><<<<<< == <<<
 
         This function is called when +/-/>/< is encountered, returning the delta count.
-        For example, `count_delta("+", "-")` on `+++--` returns 1.
+        For example, `count_delta(ADDS, "+", "-")` on `+++--` returns 1.
+        """
+
+        run = pattern.match(self.code, self.ptr)
+
+        # The run ends on the instruction AFTER the
+        # sequence, so stop the code pointer one before it
+        self.ptr = run.end() - 1
+
+        return run.group(0).count(positive) - run.group(0).count(negative)
+
+    def parse_offset_adds(self) -> tuple[dict[int, int], int] | None:
+        """
+        A run of +/-/>/< only changes cells at fixed offsets from where the
+        pointer was when the run started, and then moves the pointer once, e.g.:
+
+            # Add 3 to the cell 2 to the right
+            >>+++<< == tape[ptr + 2] += 3
+
+            # Add 1 to the cell to the right and 2 to the one after it,
+            # then move to the cell after that
+            >+>++> == tape[ptr + 1] += 1, tape[ptr + 2] += 2, ptr += 3
+
+        This function returns the amount to add to each offset and the final
+        pointer move. For example, `>+>++>` returns `({1: 1, 2: 2}, 3)`.
+        `None` means the run only adds or only moves, which `count_delta`
+        handles. A run whose adds cancel out, like `+-><`, returns `({}, 0)`.
+
+        The whole run is consumed at once, so each character is only looked
+        at once no matter how the run is shaped.
         """
 
-        count = 0
+        run = MOVES_AND_ADDS.match(self.code, self.ptr)
+        if run is None:
+            return None
 
-        while self.code[self.ptr] in (positive, negative):
-            if self.code[self.ptr] == positive:
-                count += 1
-            else:
-                count -= 1
-            self.ptr += 1
+        offset = 0
+        amounts: dict[int, int] = {}
+        moved = False
+
+        for c in run.group(0):
+            match c:
+                case ">":
+                    offset += 1
+                    moved = True
+                case "<":
+                    offset -= 1
+                    moved = True
+                case "+":
+                    amounts[offset] = amounts.get(offset, 0) + 1
+                case "-":
+                    amounts[offset] = amounts.get(offset, 0) - 1
+
+        if not moved or not amounts:
+            return None
 
-        # The loop above ends on the instruction AFTER the
-        # sequence, so decrement the code pointer by one
-        self.ptr -= 1
+        # Skip the entire run, even if it changes nothing, since starting
+        # again from the next character would walk the rest of it again
+        self.ptr = run.end() - 1
 
-        return count
+        amounts = {offset: amount for offset, amount in amounts.items() if amount}
+        return amounts, offset
 
-    def parse_transfer(self) -> int | None:
+    def parse_multiply(self) -> dict[int, int] | None:
         """
         [-<+>] transfers the value of the cell to the left,
         leaving it with a value of 0.
 
+        More generally, a loop that only adds to cells and leaves
+        the pointer where it started, subtracting 1 from the current
+        cell once per iteration, runs once for every unit of the cell's
+        value. [->+++>++<<] adds 3 times the value of the cell to the
+        cell one to the right and 2 times the value to the cell two to
+        the right, leaving the current cell with a value of 0.
+
         There may be any number of > and < as long as they
         both cancel out, so [-<+>] is valid while [-<+>>] isn't.
 
-        The direction can also be to the right: [->+<] transfers
-        the value of the cell one to the right.
-
-        This function returns the distance. For example, -2 means
-        2 cells to the left, and 3 means 3 cells to the right.
-        `None` means there is no transfer pattern.
+        This function returns the multiplier for each offset. For example,
+        [->+++>++<<] returns `{1: 3, 2: 2}` and [-<<+>>] returns `{-2: 1}`.
+        `None` means there is no multiply pattern.
         """
 
-        pattern = re.match(r"\[-(<+)\+(>+)\]|\[-(>+)\+(<+)\]", self.code[self.ptr :])
+        pattern = MULTIPLY.match(self.code, self.ptr)
         if pattern is None:
             return None
 
-        # In [-<<+>>], left will be "<<" and right will be ">>"
-        left, right = pattern.group(1), pattern.group(2)
-
-        if left is None or right is None or len(left) != len(right):
+        offset = 0
+        multipliers: dict[int, int] = {}
+
+        for c in pattern.group(1):
+            match c:
+                case ">":
+                    offset += 1
+                case "<":
+                    offset -= 1
+                case "+":
+                    multipliers[offset] = multipliers.get(offset, 0) + 1
+                case "-":
+                    multipliers[offset] = multipliers.get(offset, 0) - 1
+
+        if offset != 0 or multipliers.pop(0, 0) != -1:
             return None
 
         # Skip the entire pattern
-        self.ptr += len(pattern.group(0)) - 1
+        self.ptr = pattern.end() - 1
+
+        return {offset: mul for offset, mul in multipliers.items() if mul}
+
+
+def cache_path(code: str, suffix: str) -> Path:
+    """
+    Returns where the code generated for the given (comment-free)
+    Brainfuck code is cached, e.g. `.marshal` for a Python code object
+    or `.so` for a compiled C library. The key covers `CACHE_VERSION` so
+    that changes to the code generators don't reuse stale output.
+    """
+
+    key = hashlib.blake2b(f"{CACHE_VERSION}:{code}".encode()).hexdigest()
+    return CACHE_DIR / f"{key}{suffix}"
+
 
-        direction = -1 if left[0] == "<" else 1
-        distance = len(left) * direction
-        return distance
+@contextmanager
+def cache_entry(path: Path) -> Iterator[Path]:
+    """
+    Yields a temporary file next to the cache entry at `path` to write
+    the entry to, and moves it into place once the block finishes. An
+    interrupted or concurrent run can then never leave a partial entry
+    behind to be loaded on the next run.
+    """
 
+    path.parent.mkdir(parents=True, exist_ok=True)
+    fd, partial = tempfile.mkstemp(suffix=path.suffix, dir=path.parent)
+    os.close(fd)
 
-def run(path: str):
-    bf = Brainfuck(path)
-    py = Python()
+    try:
+        yield Path(partial)
+        os.replace(partial, path)
+    finally:
+        if os.path.exists(partial):
+            os.remove(partial)
+
+
+def parse(bf: Brainfuck) -> list[Instruction]:
+    instructions: list[Instruction] = []
 
     while bf.ptr < len(bf.code):
-        match list(bf.code[bf.ptr :]):
+        # No pattern below looks more than 3 characters ahead, so only those
+        # are matched on instead of copying the whole rest of the code
+        match list(bf.code[bf.ptr : bf.ptr + 3]):
+            case [*_] if (offset_adds := bf.parse_offset_adds()) is not None:
+                amounts, count = offset_adds
+                for offset, amount in amounts.items():
+                    instructions.append(Add(offset, amount))
+                if count:
+                    instructions.append(Move(count))
+
             case ["+" | "-", *_]:
-                count = bf.count_delta("+", "-")
-                py.emit(f"tape[ptr] += {count}")
+                instructions.append(Add(0, bf.count_delta(ADDS, "+", "-")))
 
             case [">" | "<", *_]:
-                count = bf.count_delta(">", "<")
-                py.emit(f"ptr += {count}")
+                instructions.append(Move(bf.count_delta(MOVES, ">", "<")))
 
             # [-] and [+] effectively set the current cell to 0
             case ["[", "-" | "+", "]", *_]:
-                py.emit("tape[ptr] = 0")
+                instructions.append(Clear())
                 bf.ptr += 2
 
-            case [*_] if distance := bf.parse_transfer():
-                py.emit(f"tape[ptr + {distance}] += tape[ptr]")
-                py.emit("tape[ptr] = 0")
+            case ["[", *_] if (multipliers := bf.parse_multiply()) is not None:
+                instructions.append(Multiply(tuple(multipliers.items())))
+
+            # [>] and [<] move to the nearest 0 cell in that direction
+            case ["[", ">" | "<" as direction, "]", *_]:
+                instructions.append(Scan(1 if direction == ">" else -1))
+                bf.ptr += 2
 
             case ["[", *_]:
-                py.emit("while tape[ptr] != 0:")
-                py.indent()
+                instructions.append(Loop())
             case ["]", *_]:
-                py.dedent()
+                instructions.append(EndLoop())
 
             case [",", *_]:
-                py.emit("tape[ptr] = ord(input()[:1] or '\\0')")
+                instructions.append(Input())
             case [".", *_]:
-                py.emit("print(chr(tape[ptr]), end='')")
+                instructions.append(Output())
 
         bf.ptr += 1
 
-    py.exec()
+    return instructions
+
+
+def fold_output(instructions: list[Instruction]) -> list[Instruction]:
+    """
+    Wherever the value of the current cell is known when reaching a `.`,
+    e.g. right after `[-]+++`, the byte being output is a constant and
+    doesn't need to be read from the tape. Such outputs become `Write`s.
+
+    A `Write` doesn't depend on the tape, so it can be delayed past
+    anything that doesn't output, read input or branch. Consecutive
+    `Write`s are merged into one, so `[-]+++.+.+.` outputs the bytes 3, 4
+    and 5 all at once.
+    """
+
+    folded: list[Instruction] = []
+    pending = bytearray()
+
+    # Known values by offset from the current cell, where `None` means
+    # unknown. Until the first loop, every cell not in here is still 0
+    known: dict[int, int | None] = {}
+    untouched_are_zero = True
+
+    def value(offset: int) -> int | None:
+        if offset in known:
+            return known[offset]
+        return 0 if untouched_are_zero else None
+
+    def flush():
+        if pending:
+            folded.append(Write(bytes(pending)))
+            pending.clear()
+
+    for instruction in instructions:
+        match instruction:
+            case Add(offset, amount):
+                cell = value(offset)
+                known[offset] = None if cell is None else (cell + amount) & 0xFF
+
+            case Move(count):
+                known = {offset - count: cell for offset, cell in known.items()}
+
+            case Clear():
+                known[0] = 0
+
+            case Multiply(multipliers):
+                counter = value(0)
+                for offset, mul in multipliers:
+                    cell = value(offset)
+                    if counter is None or cell is None:
+                        known[offset] = None
+                    else:
+                        known[offset] = (cell + counter * mul) & 0xFF
+                known[0] = 0
+
+            case Output() if (cell := value(0)) is not None:
+                pending.append(cell)
+                continue
+
+            case Output():
+                flush()
+
+            case Input():
+                flush()
+                known[0] = None
+
+            # The pointer could end up anywhere, but it's on a 0 cell
+            case Scan() | EndLoop():
+                flush()
+                known = {0: 0}
+                untouched_are_zero = False
+
+            case Loop():
+                flush()
+                known = {}
+                untouched_are_zero = False
+
+        folded.append(instruction)
+
+    flush()
+
+    return folded
+
+
+def generate(instructions: list[Instruction], out: Code) -> Code:
+    for instruction in instructions:
+        match instruction:
+            case Add(offset, amount):
+                out.add(offset, amount)
+            case Move(count):
+                out.move(count)
+            case Clear():
+                out.clear()
+            case Multiply(multipliers):
+                out.multiply(multipliers)
+            case Scan(step):
+                out.scan(step)
+            case Loop():
+                out.loop()
+            case EndLoop():
+                out.end_loop()
+            case Input():
+                out.input()
+            case Output():
+                out.output()
+            case Write(data):
+                out.write(data)
+
+    return out
+
+
+def run_python(bf: Brainfuck):
+    """
+    Runs the program as Python. What gets cached is the compiled code
+    object rather than the source, so a cache hit skips both parsing and
+    CPython's own compiler, which is slow on the long generated code.
+    """
+
+    # Like .pyc files, marshalled code only loads on the same Python version
+    cached = cache_path(bf.code, f".{implementation.cache_tag}.marshal")
+
+    try:
+        code = marshal.loads(cached.read_bytes())
+    except (OSError, EOFError, ValueError, TypeError):
+        source = generate(fold_output(parse(bf)), Python()).source()
+        code = compile(source, "<brainfuck>", "exec")
+        try:
+            with cache_entry(cached) as partial:
+                partial.write_bytes(marshal.dumps(code))
+        except OSError:
+            # The cache only saves time, so carry on if it can't be written
+            pass
+
+    namespace = {}
+    exec(code, namespace)
+    namespace["program"]()
+
+
+def compile_c(source: str, library: Path):
+    try:
+        subprocess.run(
+            ["cc", "-O2", "-shared", "-fPIC", "-x", "c", "-", "-o", library],
+            input=source,
+            text=True,
+            check=True,
+        )
+    except FileNotFoundError:
+        print("DEMENTIA_BACKEND=c needs a C compiler (cc)", file=stderr)
+        raise SystemExit(1)
+    except subprocess.CalledProcessError:
+        print("Compiling the generated C code failed", file=stderr)
+        raise SystemExit(1)
+
+
+def call_c(library: Path):
+    tape = ctypes.create_string_buffer(30000)
+    ctypes.CDLL(str(library)).run(tape)
+
+
+def run_c(bf: Brainfuck):
+    """
+    Compiles the program to a shared library with the system C compiler
+    and calls it through ctypes. Unlike the Python code, the library has
+    to exist on disk to be loaded, so it goes through the cache, or a
+    temporary directory if the cache can't be written.
+    """
 
+    library = cache_path(bf.code, ".so")
 
-match argv:
-    case [_, path]:
-        run(path)
-    case _:
-        print("Usage: python dementia.py <path to Brainfuck program>", file=stderr)
+    if not library.exists():
+        source = generate(fold_output(parse(bf)), C()).source()
+        try:
+            with cache_entry(library) as partial:
+                compile_c(source, partial)
+        except OSError:
+            # The cache only saves time, so if it can't be written, build
+            # the library somewhere temporary and load it from there
+            with tempfile.TemporaryDirectory() as directory:
+                library = Path(directory) / "program.so"
+                compile_c(source, library)
+                call_c(library)
+            return
+
+    call_c(library)
+
+
+BACKENDS = {"python": run_python, "c": run_c}
+
+
+def run(path: str, backend: str = "python"):
+    BACKENDS[backend](Brainfuck(path))
+
+
+def main():
+    backend = os.environ.get("DEMENTIA_BACKEND", "python")
+
+    if backend not in BACKENDS:
+        print(
+            f"Unknown DEMENTIA_BACKEND {backend!r}, expected one of: "
+            + ", ".join(BACKENDS),
+            file=stderr,
+        )
         raise SystemExit(1)
+
+    match argv:
+        case [_, path]:
+            run(path, backend)
+        case _:
+            print("Usage: python dementia.py <path to Brainfuck program>", file=stderr)
+            raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,182 @@
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+from pathlib import Path
+
+DEMENTIA = Path(__file__).with_name("dementia.py")
+
+
+def run(
+    code: str,
+    input: bytes = b"",
+    home: str | None = None,
+    backend: str = "python",
+) -> bytes:
+    with tempfile.TemporaryDirectory() as directory:
+        program = Path(directory) / "program.b"
+        program.write_text(code)
+        result = subprocess.run(
+            [sys.executable, DEMENTIA, program],
+            input=input,
+            capture_output=True,
+            check=True,
+            # Keep the cache out of the real home directory
+            env={**os.environ, "HOME": home or directory, "DEMENTIA_BACKEND": backend},
+        )
+        return result.stdout
+
+
+class TestOffsetAdds(unittest.TestCase):
+    def test_balanced(self):
+        self.assertEqual(run(">+>++<<.>.>."), b"\x00\x01\x02")
+
+    def test_unbalanced(self):
+        self.assertEqual(run(">+>++>+++.<.<.<."), b"\x03\x02\x01\x00")
+
+    def test_no_change(self):
+        self.assertEqual(run("+[-][><]+."), b"\x01")
+
+    def test_cancelling(self):
+        self.assertEqual(run("+>+-<.>." + "><+-" * 1000 + "."), b"\x01\x00\x00")
+
+
+class TestMultiply(unittest.TestCase):
+    def test_right(self):
+        self.assertEqual(run("+++[->+++>++<<].>.>."), b"\x00\x09\x06")
+
+    def test_left(self):
+        self.assertEqual(run(">>++++[-<<+>>]<<.>>."), b"\x04\x00")
+
+    def test_zero_counter(self):
+        self.assertEqual(run(">+<[->++<]>."), b"\x01")
+
+    def test_wrapping(self):
+        self.assertEqual(run("++++++++++++++++[->++++++++++++++++<]>+."), b"\x01")
+
+
+class TestScan(unittest.TestCase):
+    def test_right(self):
+        self.assertEqual(run("+>+>+<<[>]++.<.>>."), b"\x02\x01\x00")
+
+    def test_left(self):
+        self.assertEqual(run(">+>+>+[<]+.>.>.>."), b"\x01\x01\x01\x01")
+
+    def test_already_zero(self):
+        self.assertEqual(run(">+<[>][<]+."), b"\x01")
+
+
+class TestIO(unittest.TestCase):
+    def test_echo(self):
+        self.assertEqual(run(",.,.", b"ab"), b"ab")
+
+    def test_end_of_input(self):
+        self.assertEqual(run("+,.", b""), b"\x00")
+
+    def test_large_output(self):
+        self.assertEqual(run("+" * 65 + "[>" + "." * 100 + "<-]"), b"\x00" * 6500)
+
+
+class TestFoldOutput(unittest.TestCase):
+    def test_merged_writes(self):
+        self.assertEqual(run("[-]+++.+.+."), b"\x03\x04\x05")
+
+    def test_order_around_output(self):
+        # The middle . reads a cell that's only known at run time
+        self.assertEqual(run("+++.>,.<+.", b"a"), b"\x03a\x04")
+
+    def test_order_around_input(self):
+        self.assertEqual(run("++.,.++.", b"x"), b"\x02xz")
+
+    def test_forgotten_after_loop(self):
+        # The loop runs 3 times, which a single pass over its body can't tell
+        self.assertEqual(run("+++[>+<-.]>."), b"\x02\x01\x00\x03")
+
+    def test_forgotten_after_multiply(self):
+        # The counter comes from input, so its targets aren't known
+        self.assertEqual(run(",[->++<]>.", b"\x03"), b"\x06")
+
+    @unittest.skipUnless(shutil.which("cc"), "needs a C compiler")
+    def test_same_as_c(self):
+        for code, input in [
+            ("[-]+++.+.+.", b""),
+            ("+++.>,.<+.", b"a"),
+            ("++.,.++.", b"x"),
+            ("+++[>+<-.]>.", b""),
+            (",[->++<]>.", b"\x03"),
+            ("+" * 65 + "." * 10 + "[>+>+<<-]>.>.", b""),
+        ]:
+            with self.subTest(code=code):
+                self.assertEqual(run(code, input, backend="c"), run(code, input))
+
+
+class TestBasicBlocks(unittest.TestCase):
+    def test_clear_then_add(self):
+        self.assertEqual(run(",[-]+++.", b"a"), b"\x03")
+
+    def test_moves_between_adds(self):
+        self.assertEqual(run(",>+>[-]++>-<<<.>.>.>.", b"a"), b"a\x01\x02\xff")
+
+    def test_cancelling_adds(self):
+        # The body generates no code, which used to leave an empty `while`
+        self.assertEqual(run("[+-]+."), b"\x01")
+
+    def test_nested(self):
+        self.assertEqual(run("[[+-]>]+."), b"\x01")
+
+    @unittest.skipUnless(shutil.which("cc"), "needs a C compiler")
+    def test_same_as_c(self):
+        for code in ["[+-]+.", "[[+-]>]+.", ",[-]+++.", ",>+>[-]++>-<<<.>.>.>."]:
+            with self.subTest(code=code):
+                self.assertEqual(run(code, b"a", backend="c"), run(code, b"a"))
+
+
+class TestParse(unittest.TestCase):
+    def test_long_program(self):
+        # Parsing used to copy the rest of the code for every instruction
+        expected = bytes(i & 0xFF for i in range(1, 50001))
+        self.assertEqual(run("+." * 50000), expected)
+
+
+class TestCache(unittest.TestCase):
+    def test_reuse(self):
+        with tempfile.TemporaryDirectory() as home:
+            self.assertEqual(run("+++.", home=home), b"\x03")
+            self.assertEqual(run("+++. comments don't matter", home=home), b"\x03")
+
+            # Only the finished entry is left behind
+            entries = list((Path(home) / ".cache" / "dementia").iterdir())
+            self.assertEqual(len(entries), 1)
+
+    def test_unwritable(self):
+        with tempfile.TemporaryDirectory() as home:
+            (Path(home) / ".cache").write_text("not a directory")
+            self.assertEqual(run("+++.", home=home), b"\x03")
+
+    def test_corrupt(self):
+        with tempfile.TemporaryDirectory() as home:
+            run("+++.", home=home)
+            for entry in (Path(home) / ".cache" / "dementia").iterdir():
+                entry.write_bytes(b"garbage")
+            self.assertEqual(run("+++.", home=home), b"\x03")
+
+
+@unittest.skipUnless(shutil.which("cc"), "needs a C compiler")
+class TestC(unittest.TestCase):
+    def test_program(self):
+        code = (DEMENTIA.parent / "programs" / "hello.b").read_text()
+        self.assertEqual(run(code, backend="c"), run(code))
+
+    def test_io(self):
+        self.assertEqual(run(",.,.,.", b"ab", backend="c"), b"ab\x00")
+
+    def test_unwritable(self):
+        with tempfile.TemporaryDirectory() as home:
+            (Path(home) / ".cache").write_text("not a directory")
+            self.assertEqual(run("+++.", home=home, backend="c"), b"\x03")
+
+
+if __name__ == "__main__":
+    unittest.main()